@@ -1,8 +1,8 @@
 
 from pickle import TRUE
 import pygame
-import random
 import numpy as np
+from numba import njit, prange
 import sys
 
 # init
@@ -39,109 +39,369 @@ SMALL_FONT = pygame.font.SysFont("Arial",24,bold=True)
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("2048")
 
+# The board is a 64-bit bitboard: cell (i, j) is the nibble at bit 4 * (SIZE * i + j)
+# and stores log2 of the tile value (0 for an empty cell). Row i is the 16-bit word
+# at bit 16 * i, with column j in its nibble at bit 4 * j.
+ROW_MASK = 0xFFFF
+CELL_MASK = 0xF
+
+@njit(cache=True)
+def _slide_row(row):
+    """Slide and merge one 16-bit row towards column 0, return the new row and its score"""
+    new_row = 0
+    score = 0
+    write = 0 # next column to fill
+    last = 0 # tile at column write - 1 if it can still be merged, else 0
+    for j in range(SIZE):
+        v = (row >> (4 * j)) & CELL_MASK
+        # skip "0"
+        if v == 0:
+            continue
+        # combine the same numbers (a nibble can not hold anything above 2 ** 15)
+        if v == last and v < CELL_MASK:
+            new_row += 1 << (4 * (write - 1))
+            score += 1 << (v + 1)
+            last = 0
+        else:
+            new_row |= v << (4 * write)
+            last = v
+            write += 1
+    return new_row, score
+
+@njit(cache=True)
+def _reverse_row(row):
+    return ((row & 0xF) << 12) | ((row & 0xF0) << 4) | ((row >> 4) & 0xF0) | (row >> 12)
+
+@njit(cache=True)
+def _unpack_column(row):
+    """Spread the four nibbles of a 16-bit row over column 0 of a bitboard"""
+    return (row & 0xF) | ((row & 0xF0) << 12) | ((row & 0xF00) << 24) | ((row & 0xF000) << 36)
+
+@njit(cache=True)
+def _build_tables():
+    """Precompute the result of a move and its score for every possible row
+
+    The left / right tables give the new 16-bit row. The up / down tables take a
+    column read out as a row (top cell first) and give the new column already
+    spread back into column 0 of a bitboard.
+    """
+    left = np.empty(ROW_MASK + 1, dtype=np.uint16)
+    right = np.empty(ROW_MASK + 1, dtype=np.uint16)
+    up = np.empty(ROW_MASK + 1, dtype=np.uint64)
+    down = np.empty(ROW_MASK + 1, dtype=np.uint64)
+    score = np.empty(ROW_MASK + 1, dtype=np.uint32)
+    for row in range(ROW_MASK + 1):
+        new_row, reward = _slide_row(row)
+        reversed_row = _reverse_row(row)
+        left[row] = new_row
+        right[reversed_row] = _reverse_row(new_row)
+        up[row] = _unpack_column(new_row)
+        down[reversed_row] = _unpack_column(_reverse_row(new_row))
+        # merging depends only on runs of equal tiles, so both directions score the same
+        score[row] = reward
+    return left, right, up, down, score
+
+LEFT_TABLE, RIGHT_TABLE, UP_TABLE, DOWN_TABLE, SCORE_TABLE = _build_tables()
+
+# The move kernels below work on np.uint64 bitboards only, mixing in signed
+# integers would make Numba promote them to floats.
+U4 = np.uint64(4)
+U8 = np.uint64(8)
+U12 = np.uint64(12)
+U16 = np.uint64(16)
+U24 = np.uint64(24)
+U32 = np.uint64(32)
+U48 = np.uint64(48)
+U_ROW_MASK = np.uint64(ROW_MASK)
+
+@njit(cache=True)
+def _transpose(board):
+    """Transpose the bitboard (swap rows and columns) with three butterfly steps"""
+    a1 = board & np.uint64(0xF0F00F0FF0F00F0F)
+    a2 = board & np.uint64(0x0000F0F00000F0F0)
+    a3 = board & np.uint64(0x0F0F00000F0F0000)
+    a = a1 | (a2 << U12) | (a3 >> U12)
+    b1 = a & np.uint64(0xFF00FF0000FF00FF)
+    b2 = a & np.uint64(0x00FF00FF00000000)
+    b3 = a & np.uint64(0x00000000FF00FF00)
+    return b1 | (b2 >> U24) | (b3 << U24)
+
+@njit(cache=True)
+def _empty_cells(board):
+    """Return a mask with the lowest bit of every zero nibble of the bitboard set"""
+    occupied = board | (board >> np.uint64(1))
+    occupied |= occupied >> np.uint64(2)
+    return ~occupied & np.uint64(0x1111111111111111)
+
+# The board size is fixed, so the moves below are unrolled over the four rows / columns
+@njit(cache=True, boundscheck=False)
+def _slide_rows(board, table):
+    r0 = board & U_ROW_MASK
+    r1 = (board >> U16) & U_ROW_MASK
+    r2 = (board >> U32) & U_ROW_MASK
+    r3 = board >> U48
+    new_board = (np.uint64(table[r0]) | (np.uint64(table[r1]) << U16)
+                 | (np.uint64(table[r2]) << U32) | (np.uint64(table[r3]) << U48))
+    score = SCORE_TABLE[r0] + SCORE_TABLE[r1] + SCORE_TABLE[r2] + SCORE_TABLE[r3]
+    return new_board, score
+
+@njit(cache=True, boundscheck=False)
+def _slide_columns(board, table):
+    # read the columns out as rows once, the column tables write them straight back as columns
+    columns = _transpose(board)
+    c0 = columns & U_ROW_MASK
+    c1 = (columns >> U16) & U_ROW_MASK
+    c2 = (columns >> U32) & U_ROW_MASK
+    c3 = columns >> U48
+    new_board = table[c0] | (table[c1] << U4) | (table[c2] << U8) | (table[c3] << U12)
+    score = SCORE_TABLE[c0] + SCORE_TABLE[c1] + SCORE_TABLE[c2] + SCORE_TABLE[c3]
+    return new_board, score
+
+@njit(cache=True)
+def move_up(board):
+    return _slide_columns(board, UP_TABLE)
+
+@njit(cache=True)
+def move_right(board):
+    return _slide_rows(board, RIGHT_TABLE)
+
+@njit(cache=True)
+def move_down(board):
+    return _slide_columns(board, DOWN_TABLE)
+
+@njit(cache=True)
+def move_left(board):
+    return _slide_rows(board, LEFT_TABLE)
+
+@njit(cache=True)
+def execute_move(board, direction):
+    """Apply a move to a bitboard, return the new bitboard and the score gained"""
+    # 0: up, 1: right, 2: down, 3: left
+    if direction == 0:
+        return move_up(board)
+    elif direction == 1:
+        return move_right(board)
+    elif direction == 2:
+        return move_down(board)
+    return move_left(board)
+
+@njit(cache=True)
+def _place_tile(board, cell_draw, value_draw):
+    """Put a new tile on the bitboard from two uniform draws in [0, 1)
+
+    cell_draw picks the empty cell, value_draw < 0.9 makes it a 2, otherwise a 4.
+    """
+    empty_cells = _empty_cells(board)
+    count = 0
+    mask = empty_cells
+    while mask:
+        mask &= mask - np.uint64(1)
+        count += 1
+    if count == 0:
+        return board
+
+    # drop a random number of lower empty cells, then take the lowest remaining one
+    for _ in range(min(int(cell_draw * count), count - 1)):
+        empty_cells &= empty_cells - np.uint64(1)
+    cell = empty_cells & (~empty_cells + np.uint64(1))
+    # store log2 of the new tile: 1 for a "2", 2 for a "4"
+    return board | (cell if value_draw < 0.9 else cell << np.uint64(1))
+
+@njit(cache=True)
+def add_random_tile(board):
+    """Put a 2 (90%) or a 4 (10%) on a random empty cell of the bitboard"""
+    return _place_tile(board, np.random.random(), np.random.random())
+
+@njit(cache=True)
+def seed_random(seed):
+    """Seed the random generator the kernels draw new tiles from
+
+    Numba keeps its own generator, random.seed / np.random.seed called from Python do not affect it.
+    """
+    np.random.seed(seed)
+
+@njit(cache=True)
+def is_board_over(board):
+    """Tell whether no move can change the bitboard any more"""
+    if _empty_cells(board):
+        return False
+
+    # a zero nibble in the XOR with the right / lower neighbour means the two tiles can merge
+    if _empty_cells(board ^ (board >> U4)) & np.uint64(0x0111011101110111):
+        return False
+    if _empty_cells(board ^ (board >> U16)) & np.uint64(0x0000111111111111):
+        return False
+
+    return True
+
+# Batched simulation, one independent game per bitboard, for self-play / RL training
+# The random numbers are drawn up front on the calling thread, every worker thread has its
+# own generator state, so drawing inside prange would not be reproducible with seed_random.
+@njit(parallel=True, cache=True)
+def new_boards(count):
+    """Start count games, each with two random tiles"""
+    draws = np.random.random((count, 4))
+    boards = np.zeros(count, dtype=np.uint64)
+    for k in prange(count):
+        board = _place_tile(boards[k], draws[k, 0], draws[k, 1])
+        boards[k] = _place_tile(board, draws[k, 2], draws[k, 3])
+    return boards
+
+@njit(parallel=True, cache=True)
+def rollout(boards, actions):
+    """Apply actions[k] to boards[k] in parallel, return the new boards and the rewards
+
+    A random tile is added to every board the action changed, like a move in the game.
+    """
+    if len(actions) != len(boards):
+        raise ValueError("rollout needs exactly one action per board")
+
+    draws = np.random.random((len(boards), 2))
+    new = np.empty_like(boards)
+    rewards = np.zeros(len(boards), dtype=np.int32)
+    for k in prange(len(boards)):
+        board, score = execute_move(boards[k], actions[k])
+        if board != boards[k]:
+            board = _place_tile(board, draws[k, 0], draws[k, 1])
+            rewards[k] = score
+        new[k] = board
+    return new, rewards
+
+@njit(parallel=True, cache=True)
+def boards_over(boards):
+    """Tell for every bitboard whether its game is over"""
+    over = np.empty(len(boards), dtype=np.bool_)
+    for k in prange(len(boards)):
+        over[k] = is_board_over(boards[k])
+    return over
+
 class Game2048:
-    def __init__(self):
+    def __init__(self, batch=None, seed=None):
+        # with batch=N, board / score / game_over hold N independent headless games
+        self.batch = batch
+        # seed makes the new tiles, and so whole games, reproducible
+        if seed is not None:
+            seed_random(seed)
+        if batch is None:
+            # render the number of every possible tile once instead of every frame
+            self.tile_surfaces = {}
+            for exponent in range(1, CELL_MASK + 1):
+                value = 1 << exponent
+                text_color = COLORS['text'] if value <= 4 else COLORS['text_light']
+                self.tile_surfaces[value] = FONT.render(str(value), True, text_color)
+            self.restart_surface = SMALL_FONT.render("Press R to restart", True, COLORS['text_light'])
         self.reset()
 
     def reset(self):
-        self.board = np.zeros((SIZE, SIZE),dtype=int)
+        if self.batch is not None:
+            self.board = new_boards(self.batch)
+            self.score = np.zeros(self.batch, dtype=np.int64)
+            self.game_over = boards_over(self.board)
+            return
+
+        self.board = np.uint64(0)
         self.score = 0
         self.add_new_tile()
         self.add_new_tile()
         self.game_over = False
+        self.invalidate()
+
+    def get_tile(self, i, j):
+        """Decode the tile value of cell (i, j) from the bitboard"""
+        exponent = (int(self.board) >> (4 * (SIZE * i + j))) & CELL_MASK
+        return 1 << exponent if exponent else 0
 
     def add_new_tile(self):
-        empty_cells = [(i, j) for i in range(SIZE) for j in range(SIZE) if self.board[i][j] == 0]
-        if empty_cells:
-            i, j = random.choice(empty_cells)
-            self.board[i][j] = 2 if random.random() < 0.9 else 4
+        # Numba hands uint64 scalars back as Python ints, keep the board an np.uint64
+        self.board = np.uint64(add_random_tile(self.board))
 
     def move(self, direction):
         # 0: up, 1: right, 2: down, 3: left
-        moved = False
-        board_before = self.board.copy()
+        if self.batch is not None:
+            # direction holds one action per game, or one for all of them, return which games moved
+            board_before = self.board
+            actions = np.ascontiguousarray(np.broadcast_to(np.asarray(direction, dtype=np.int32), board_before.shape))
+            self.board, rewards = rollout(board_before, actions)
+            self.score += rewards
+            self.game_over = boards_over(self.board)
+            return self.board != board_before
 
-        if direction == 0: # up
-            self.board = self.board.T
-        elif direction == 1: # right
-            self.board = np.fliplr(self.board)
-        elif direction == 2: # down
-            self.board = np.fliplr(self.board).T
+        moved = False
+        board, score = execute_move(self.board, direction)
 
-        for i in range(SIZE):
-            row = self.board[i]
-            # remove "0"
-            non_zero  = row[row != 0]
-            # combine the same numbers
-            for j in range(len(non_zero) - 1):
-                if non_zero[j] == non_zero[j + 1]:
-                    non_zero[j] *= 2
-                    non_zero[j + 1] = 0
-                    self.score += non_zero[j]
-            # remove "0" again
-            non_zero = non_zero[non_zero != 0]
-            # add "0"
-            new_row = np.zeros(SIZE, dtype=int)
-            new_row[:len(non_zero)] = non_zero
-            self.board[i]= new_row
-
-        if direction == 0: # up
-            self.board = self.board.T
-        elif direction == 1: # right
-            self.board = np.fliplr(self.board)
-        elif direction == 2: # down
-            self.board = np.fliplr(self.board.T)
-
-        if not np.array_equal(board_before, self.board):
+        if board != self.board:
             moved = True
+            self.board = np.uint64(board)
+            self.score += int(score)
+            self.dirty = True
             self.add_new_tile()
             if self.is_game_over():
                 self.game_over = True
 
         return moved
     def is_game_over(self):
-        if 0 in self.board:
-            return False
-
-        for i in range(SIZE):
-            for j in range(SIZE):
-                if j < SIZE - 1 and self.board[i][j] == self.board[i][j + 1]:
-                    return False
-                if i < SIZE - 1 and self.board[i][j] == self.board[i + 1][j]:
-                    return False
-
-        return True
+        if self.batch is not None:
+            return boards_over(self.board)
+        return is_board_over(self.board)
+
+    def invalidate(self):
+        """Force the next draw to repaint the whole window"""
+        self._drawn_board = None
+        self.dirty = True
+
+    def draw_tile(self, i, j):
+        """Draw cell (i, j) and return the rect it covers"""
+        value = self.get_tile(i, j)
+        color = COLORS[value] if value in COLORS else COLORS[2048]
+
+        # calculate grids' positions
+        x = GRID_MARGIN + j * (GRID_SIZE + GRID_MARGIN)
+        y = 50 + GRID_MARGIN + i * (GRID_SIZE + GRID_MARGIN)
+
+        # draw background
+        rect = pygame.draw.rect(screen, color, (x, y, GRID_SIZE, GRID_SIZE), 0, 5)
+
+        # draw number if it exists
+        if value != 0:
+            text = self.tile_surfaces[value]
+            text_rect = text.get_rect(center=(x + GRID_SIZE // 2, y + GRID_SIZE // 2))
+            screen.blit(text, text_rect)
+        return rect
 
     def draw(self):
-        screen.fill(COLORS['background'])
+        previous_board = self._drawn_board
+        # only the changed tiles and the score need repainting while playing
+        partial = previous_board is not None and not self.game_over
+        self._drawn_board = self.board
+        self.dirty = False
+
+        if partial:
+            score_rect = pygame.Rect(0, 0, WIDTH - 180, 50)
+            screen.fill(COLORS['background'], score_rect)
+        else:
+            screen.fill(COLORS['background'])
 
         # draw scores
         score_text = SMALL_FONT.render(f"Score: {self.score}", True, COLORS['text_light'])
         screen.blit(score_text, (10, 10))
 
+        if partial:
+            dirty_rects = [score_rect]
+            # the nibbles of changed cells are the non-zero ones in the XOR of both bitboards
+            changed = int(self.board) ^ int(previous_board)
+            for cell in range(SIZE * SIZE):
+                if (changed >> (4 * cell)) & CELL_MASK:
+                    dirty_rects.append(self.draw_tile(cell // SIZE, cell % SIZE))
+            pygame.display.update(dirty_rects)
+            return
+
         # draw button "Restart"
-        restart_text = SMALL_FONT.render("Press R to restart", True, COLORS['text_light'])
-        screen.blit(restart_text, (WIDTH - 180, 10))
+        screen.blit(self.restart_surface, (WIDTH - 180, 10))
 
         # draw game
         for i in range(SIZE):
             for j in range(SIZE):
-                value = self.board[i][j]
-                color = COLORS[value] if value in COLORS else COLORS[2048]
-
-                # calculate grids' positions
-                x = GRID_MARGIN + j * (GRID_SIZE + GRID_MARGIN)
-                y = 50 + GRID_MARGIN + i * (GRID_SIZE + GRID_MARGIN)
-
-                # draw background
-                pygame.draw.rect(screen, color, (x, y, GRID_SIZE, GRID_SIZE), 0, 5)
-
-                # draw number if it exists
-                if value != 0:
-                    text_color = COLORS['text'] if value <= 4 else COLORS['text_light']
-                    text = FONT.render(str(value), True, text_color)
-                    text_rect = text.get_rect(center=(x + GRID_SIZE // 2, y + GRID_SIZE // 2))
-                    screen.blit(text, text_rect)
+                self.draw_tile(i, j)
 
         # display ending information if gameover
         if self.game_over:
@@ -169,6 +429,10 @@ def main():
                 pygame.quit()
                 sys.exit()
 
+            # the window content was lost, e.g. after being covered or restored
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                game.invalidate()
+
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_r:
                     game.reset()
@@ -182,7 +446,8 @@ def main():
                     elif event.key == pygame.K_LEFT:
                         game.move(3)
 
-        game.draw()
+        if game.dirty:
+            game.draw()
         clock.tick(30)
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import os
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import numpy as np
+
+from _2048游戏 import CELL_MASK, SIZE, add_random_tile, execute_move, is_board_over, seed_random
+
+UP, RIGHT, DOWN, LEFT = range(4)
+
+
+def to_bitboard(grid):
+    """Pack a SIZE x SIZE list of log2 tile values into a bitboard"""
+    board = 0
+    for i in range(SIZE):
+        for j in range(SIZE):
+            board |= grid[i][j] << (4 * (SIZE * i + j))
+    return np.uint64(board)
+
+
+def to_grid(board):
+    board = int(board)
+    return [[(board >> (4 * (SIZE * i + j))) & CELL_MASK for j in range(SIZE)] for i in range(SIZE)]
+
+
+def slide_lane(lane):
+    """Slide and merge one lane of log2 values towards its start, return the new lane and the score"""
+    tiles = [v for v in lane if v]
+    merged = []
+    score = 0
+    while tiles:
+        v = tiles.pop(0)
+        # a 32768 tile does not fit into a nibble, so two of them stay apart
+        if tiles and tiles[0] == v and v < CELL_MASK:
+            tiles.pop(0)
+            merged.append(v + 1)
+            score += 1 << (v + 1)
+        else:
+            merged.append(v)
+    return merged + [0] * (SIZE - len(merged)), score
+
+
+def reference_move(grid, direction):
+    """Move a list-based grid the plain way, lane by lane"""
+    grid = [row[:] for row in grid]
+    score = 0
+    for k in range(SIZE):
+        if direction == LEFT:
+            cells = [(k, j) for j in range(SIZE)]
+        elif direction == RIGHT:
+            cells = [(k, j) for j in reversed(range(SIZE))]
+        elif direction == UP:
+            cells = [(i, k) for i in range(SIZE)]
+        else:
+            cells = [(i, k) for i in reversed(range(SIZE))]
+        lane, lane_score = slide_lane([grid[i][j] for i, j in cells])
+        for (i, j), v in zip(cells, lane):
+            grid[i][j] = v
+        score += lane_score
+    return grid, score
+
+
+def test_moves_match_reference():
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        grid = (rng.integers(0, CELL_MASK + 1, (SIZE, SIZE)) * (rng.random((SIZE, SIZE)) < 0.6)).tolist()
+        for direction in range(4):
+            expected_grid, expected_score = reference_move(grid, direction)
+            board, score = execute_move(to_bitboard(grid), direction)
+            assert to_grid(board) == expected_grid
+            assert score == expected_score
+
+
+def test_move_down():
+    # 2 / 2 / 4 / empty in the first column: the two 2s merge into the 4 above the bottom 4
+    grid = [[1, 0, 0, 3],
+            [1, 0, 0, 0],
+            [2, 0, 0, 3],
+            [0, 0, 0, 1]]
+    board, score = execute_move(to_bitboard(grid), DOWN)
+    assert to_grid(board) == [[0, 0, 0, 0],
+                              [0, 0, 0, 0],
+                              [2, 0, 0, 4],
+                              [2, 0, 0, 1]]
+    assert score == 4 + 16
+
+
+def test_32768_tiles_do_not_merge():
+    grid = [[CELL_MASK, CELL_MASK, 0, 0]] + [[0] * SIZE for _ in range(SIZE - 1)]
+    board, score = execute_move(to_bitboard(grid), LEFT)
+    assert board == to_bitboard(grid)
+    assert score == 0
+
+
+def test_board_over():
+    # alternating tiles, no empty cell and no equal neighbours
+    full = [[1 + (i + j) % 2 for j in range(SIZE)] for i in range(SIZE)]
+    assert is_board_over(to_bitboard(full))
+
+    horizontal = [row[:] for row in full]
+    horizontal[1][2] = horizontal[1][3]
+    assert not is_board_over(to_bitboard(horizontal))
+
+    vertical = [row[:] for row in full]
+    vertical[2][0] = vertical[3][0]
+    assert not is_board_over(to_bitboard(vertical))
+
+    empty = [row[:] for row in full]
+    empty[3][3] = 0
+    assert not is_board_over(to_bitboard(empty))
+
+
+def test_add_random_tile_fills_one_empty_cell_with_2_or_4():
+    seed_random(0)
+    grid = [[1, 0, 0, CELL_MASK], [0, 3, 0, 0], [0, 0, 0, 0], [2, 0, 0, 0]]
+    board = to_bitboard(grid)
+    for _ in range(500):
+        new_grid = to_grid(add_random_tile(board))
+        changed = [(i, j) for i in range(SIZE) for j in range(SIZE) if new_grid[i][j] != grid[i][j]]
+        assert len(changed) == 1
+        i, j = changed[0]
+        assert grid[i][j] == 0
+        assert new_grid[i][j] in (1, 2)
+
+    full = to_bitboard([[1 + (i + j) % 2 for j in range(SIZE)] for i in range(SIZE)])
+    assert add_random_tile(full) == full
@@ -0,0 +1,117 @@
+import argparse
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from 图片转字符画 import (
+    ASCII_CHARS, ROWS_PER_CHUNK, build_glyph_atlas, format_output, iter_output_lines, palette_size,
+    quantize_colors, render_glyphs, render_glyphs_parallel
+    )
+
+WIDTH = 40
+ROWS = 12
+CELL_SIZE = (6, 12)
+BG_COLOR = (10, 20, 30)
+
+
+def draw_cells(characters, colors, font):
+    """Reference rendering, one ImageDraw.text call per cell"""
+    img = Image.new("RGB", (WIDTH * CELL_SIZE[0], ROWS * CELL_SIZE[1]), color=BG_COLOR)
+    draw = ImageDraw.Draw(img)
+    for i, (char, color) in enumerate(zip(characters.tolist(), colors.tolist())):
+        x, y = (i % WIDTH) * CELL_SIZE[0], (i // WIDTH) * CELL_SIZE[1]
+        draw.text((x, y), char, fill=tuple(color), font=font)
+    return np.asarray(img)
+
+
+def random_cells(char_set, seed=0):
+    rng = np.random.default_rng(seed)
+    characters = np.array(char_set)[rng.integers(0, len(char_set), WIDTH * ROWS)]
+    colors = rng.integers(0, 256, (WIDTH * ROWS, 3), dtype=np.uint8)
+    return characters, colors
+
+
+def render_atlas(characters, colors, font, parallel=False):
+    glyphs, glyph_index = np.unique(characters, return_inverse=True)
+    atlas, origin = build_glyph_atlas(glyphs, font, CELL_SIZE)
+    if parallel:
+        return render_glyphs_parallel(atlas, glyph_index, colors, WIDTH, CELL_SIZE, BG_COLOR, origin, workers=3)
+    return render_glyphs(atlas, glyph_index, colors, WIDTH, CELL_SIZE, BG_COLOR, origin)
+
+
+def test_atlas_matches_per_character_drawing():
+    font = ImageFont.load_default()
+    # "," and ";" of the default font, and "j", start left of their cell
+    for char_set in (ASCII_CHARS, ASCII_CHARS + ["j", "g", "W"]):
+        characters, colors = random_cells(char_set)
+        np.testing.assert_array_equal(render_atlas(characters, colors, font), draw_cells(characters, colors, font))
+
+
+def test_parallel_stripes_match_serial_rendering():
+    font = ImageFont.load_default()
+    characters, colors = random_cells(ASCII_CHARS + ["j", "g", "W"], seed=1)
+    np.testing.assert_array_equal(
+        render_atlas(characters, colors, font, parallel=True), render_atlas(characters, colors, font)
+        )
+
+
+def test_palette_size_accepts_only_2_to_256():
+    assert palette_size("2") == 2
+    assert palette_size("256") == 256
+    for value in ("1", "257", "300", "many"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            palette_size(value)
+
+
+def reference_lines(characters, colors, width, cell):
+    """Format every cell with an f-string, one line per row"""
+    cells = [cell(char, r, g, b) for char, (r, g, b) in zip(characters.tolist(), colors.tolist())]
+    return ["".join(cells[i:i + width]) for i in range(0, len(cells), width)]
+
+
+def reference_ansi(characters, colors, width):
+    return "\n".join(reference_lines(characters, colors, width, lambda c, r, g, b: f"\033[38:2;{r};{g};{b}m{c}\033[0m"))
+
+
+def reference_html(characters, colors, width):
+    spans = reference_lines(characters, colors, width, lambda c, r, g, b: f"<span style='color:rgb({r},{g},{b})'>{c}</span>")
+    return "\n".join([
+        "<!DOCTYPE html>",
+        "<html>",
+        "<head>",
+        "<title>ASCII Art</title>",
+        "<style>",
+        "body {background-color: rgb(0, 0, 0); }",
+        ".ascii { font-family: 'Courier', monospace; font-size: 12px; line-height: 1; white-space: pre; }",
+        "</style>",
+        "</head>",
+        "<body>",
+        "<div class='ascii'>"
+        ] + spans + ["</div>", "</body>", "</html>"])
+
+
+def test_colored_text_matches_per_cell_formatting():
+    characters, colors = random_cells(ASCII_CHARS, seed=2)
+    assert format_output(characters, colors, WIDTH, "text", "ansi") == reference_ansi(characters, colors, WIDTH)
+    assert format_output(characters, colors, WIDTH, "html", "rgb") == reference_html(characters, colors, WIDTH)
+
+
+def test_palette_input_matches_per_cell_formatting():
+    characters, colors = random_cells(ASCII_CHARS, seed=3)
+    indices, palette = quantize_colors(colors, 16)
+    quantized = palette[indices]
+    assert format_output(characters, indices, WIDTH, "text", "ansi", palette=palette) == reference_ansi(characters, quantized, WIDTH)
+    assert format_output(characters, indices, WIDTH, "html", "rgb", palette=palette) == reference_html(characters, quantized, WIDTH)
+
+
+def test_lines_across_chunks_match_whole_output():
+    width = 7
+    rows = 2 * ROWS_PER_CHUNK + 3
+    rng = np.random.default_rng(4)
+    characters = np.array(ASCII_CHARS)[rng.integers(0, len(ASCII_CHARS), width * rows)]
+    colors = rng.integers(0, 256, (width * rows, 3), dtype=np.uint8)
+    for output_format, color_mode in [("text", "none"), ("text", "ansi"), ("html", "rgb")]:
+        lines = list(iter_output_lines(characters, colors, width, output_format, color_mode))
+        assert "\n".join(lines) == format_output(characters, colors, width, output_format, color_mode)
+    assert "\n".join(iter_output_lines(characters, colors, width, "text", "ansi")) == reference_ansi(characters, colors, width)
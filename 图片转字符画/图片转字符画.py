@@ -1,15 +1,22 @@
 import enum
 from multiprocessing import Value
 from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import numpy as np
 import os
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional, Union
 
 # Define the character set, arranged in order from dark to light
 ASCII_CHARS = ["@", "#", "$", "%", "?", "*", "*", "+", ";", ":", ",", "."]
 COLOR_MODES = ["none", "ansi", "html", "rgb"]
 OUTPUT_FORMATS = ["text", "html", "image"]
+# Decimal strings of every channel value, to look up instead of formatting each pixel
+DECIMALS = np.array([str(i) for i in range(256)])
+# Rows of text / html output formatted together before being written out
+ROWS_PER_CHUNK = 64
+# Image outputs with fewer character cells than this are rendered in a single process
+PARALLEL_MIN_CELLS = 40000
 
 def get_font_size(image_size: Tuple[int, int], char_size: Tuple[int, int]) -> int:
     """Calculate the appropriate font size based on the image size and character size"""
@@ -24,7 +31,10 @@ def resize_image(image: Image.Image, new_width: int, char_aspect: float = 0.5) -
     width, height = image.size
     ratio = height / width * char_aspect # Adjust the scale, consider the shape of the characters
     new_height = int(new_width * ratio)
-    resized_image = image.resize((new_width, new_height))
+    # Box filter averages the whole area behind each character when shrinking, bilinear is enough when enlarging.
+    # Both are SIMD accelerated if pillow-simd is installed in place of pillow.
+    resample = Image.Resampling.BOX if new_width < width else Image.Resampling.BILINEAR
+    resized_image = image.resize((new_width, new_height), resample=resample)
     return resized_image
 
 def image_to_ascii(
@@ -32,65 +42,205 @@ def image_to_ascii(
     char_set: List[str] = ASCII_CHARS,
     color_mode: str = "none",
     invert: bool = False
-    ) -> Tuple[List[str], List[Tuple[int, int, int]]]:
+    ) -> Tuple[np.ndarray, np.ndarray]:
     """Convert images into ASCII characters and color data"""
     if color_mode not in COLOR_MODES:
         raise ValueError(f"Invalid color mode. Choose from {COLOR_MODES}")
 
-    # Convert to RGB mode to get the color information
-    rgb_image = image.convert("RGB")
-    # Convert to grayscale image for brightness calculation
-    gray_image = image.convert("L")
+    # Convert to RGB mode to get the color information, one (r, g, b) row per pixel
+    rgb = np.asarray(image.convert("RGB"), dtype=np.uint8).reshape(-1, 3)
+    # Compute the brightness from the same array with the ITU-R 601-2 luma weights,
+    # in the same 16-bit fixed point as Pillow's convert("L")
+    weights = np.array([19595, 38470, 7471], dtype=np.uint32)
+    gray = (rgb @ weights + 0x8000) >> 16
 
-    pixels = list(gray_image.getdata())
-    rgb_pixels = list(rgb_image.getdata())
-
-    # invert light
-    if invert:
-        pixels = [255 - p for p in pixels]
-
-    # Map pixels to characters
+    # Map brightness to characters with a 256-entry lookup table, inverting light is baked into the table
     char_range = 256 // len(char_set)
-    characters = []
-    colors = []
-
-    for i, pixel in enumerate(pixels):
-        char_index = min(pixel // char_range, len(char_set) - 1)
-        characters.append(char_set[char_index])
-        colors.append(rgb_pixels[i])
-
-    return characters, colors
-
-def format_output(
-    characters: List[str],
-    colors: List[Tuple[int, int, int]],
+    levels = np.arange(256, dtype=np.uint8)
+    if invert:
+        np.subtract(255, levels, out=levels)
+    lut = np.minimum(levels // char_range, len(char_set) - 1)
+    characters = np.array(char_set)[lut][gray]
+
+    return characters, rgb
+
+def quantize_colors(colors: np.ndarray, num_colors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce the colors to a small palette, return the palette index of every pixel and the palette"""
+    quantized = Image.fromarray(colors.reshape(1, -1, 3)).quantize(colors=num_colors)
+    palette = np.array(quantized.getpalette()[:num_colors * 3], dtype=np.uint8).reshape(-1, 3)
+    return np.asarray(quantized, dtype=np.uint8).ravel(), palette
+
+def _shift_cells(offset: int, count: int) -> Tuple[slice, slice]:
+    """Return the destination and source slices that move a run of count cells by offset"""
+    if offset >= 0:
+        return slice(offset, count), slice(0, count - offset)
+    return slice(0, count + offset), slice(-offset, count)
+
+def build_glyph_atlas(
+    glyphs: np.ndarray,
+    font: ImageFont.ImageFont,
+    cell_size: Tuple[int, int]
+    ) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Render every glyph once into an alpha mask, stacked as (n, height, width)
+
+    Glyphs may be wider or taller than one character cell, or start left of or
+    above it, so the masks cover as many whole cells as needed to hold every
+    glyph without clipping. Also return the (column, row) of the glyph's own
+    cell inside the mask.
+    """
+    cell_width, cell_height = cell_size
+    boxes = [font.getbbox(str(glyph)) for glyph in glyphs]
+    left = min([0] + [box[0] for box in boxes])
+    top = min([0] + [box[1] for box in boxes])
+    right = max([cell_width] + [box[2] for box in boxes])
+    bottom = max([cell_height] + [box[3] for box in boxes])
+
+    origin = (-(left // cell_width), -(top // cell_height))
+    offset = (origin[0] * cell_width, origin[1] * cell_height)
+    tile_size = (offset[0] - (-right // cell_width) * cell_width, offset[1] - (-bottom // cell_height) * cell_height)
+
+    atlas = np.empty((len(glyphs), tile_size[1], tile_size[0]), dtype=np.uint8)
+    for k, glyph in enumerate(glyphs):
+        tile = Image.new("L", tile_size, color=0)
+        ImageDraw.Draw(tile).text(offset, str(glyph), fill=255, font=font)
+        atlas[k] = np.asarray(tile)
+    return atlas, origin
+
+def render_glyphs(
+    atlas: np.ndarray,
+    glyph_index: np.ndarray,
+    fills: np.ndarray,
+    width: int,
+    cell_size: Tuple[int, int],
+    bg_color: Tuple[int, int, int] = (0, 0, 0),
+    origin: Tuple[int, int] = (0, 0)
+    ) -> np.ndarray:
+    """Blit the glyph masks of a grid of cells in their fill colors over the background"""
+    cell_width, cell_height = cell_size
+    rows = len(glyph_index) // width
+    span_y = atlas.shape[1] // cell_height
+    span_x = atlas.shape[2] // cell_width
+
+    canvas = np.empty((rows * cell_height, width * cell_width, 3), dtype=np.uint16)
+    canvas[:] = bg_color
+    ink = fills.reshape(rows, width, 3).astype(np.uint16)
+
+    # Blend the part of every glyph that falls dy cells below and dx cells right of its own cell
+    # (negative for parts left of or above it). Going from the largest offsets to the smallest
+    # draws each pixel in the same order as rendering the cells one by one, left to right and
+    # top to bottom.
+    for dy in range(span_y - 1 - origin[1], -1 - origin[1], -1):
+        dst_y, src_y = _shift_cells(dy, rows)
+        tile_y = (dy + origin[1]) * cell_height
+        for dx in range(span_x - 1 - origin[0], -1 - origin[0], -1):
+            dst_x, src_x = _shift_cells(dx, width)
+            tile_x = (dx + origin[0]) * cell_width
+            part = atlas[:, tile_y:tile_y + cell_height, tile_x:tile_x + cell_width]
+            alpha = np.zeros((rows, width, cell_height, cell_width), dtype=np.uint16)
+            alpha[dst_y, dst_x] = part[glyph_index].reshape(rows, width, cell_height, cell_width)[src_y, src_x]
+            color = np.zeros((rows, width, 3), dtype=np.uint16)
+            color[dst_y, dst_x] = ink[src_y, src_x]
+
+            # (rows, width, h, w) cells -> one (rows * h, width * w) canvas
+            alpha = alpha.transpose(0, 2, 1, 3).reshape(canvas.shape[:2] + (1,))
+            color = np.repeat(np.repeat(color, cell_height, axis=0), cell_width, axis=1)
+            # Alpha blend in integers, 255 * 255 still fits into uint16
+            canvas = (color * alpha + canvas * (255 - alpha) + 127) // 255
+
+    return canvas.astype(np.uint8)
+
+def render_glyphs_parallel(
+    atlas: np.ndarray,
+    glyph_index: np.ndarray,
+    fills: np.ndarray,
+    width: int,
+    cell_size: Tuple[int, int],
+    bg_color: Tuple[int, int, int] = (0, 0, 0),
+    origin: Tuple[int, int] = (0, 0),
+    workers: Optional[int] = None
+    ) -> np.ndarray:
+    """Render horizontal stripes of rows in a process pool and stack them into one canvas"""
+    workers = workers or os.cpu_count() or 1
+    rows = len(glyph_index) // width
+    # Rows above a stripe whose glyphs can reach down into it, and rows below reaching up into it
+    above = atlas.shape[1] // cell_size[1] - 1 - origin[1]
+    below = origin[1]
+    bounds = np.linspace(0, rows, min(workers, rows) + 1).astype(int)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for top, bottom in zip(bounds[:-1], bounds[1:]):
+            start = max(top - above, 0)
+            end = min(bottom + below, rows)
+            stripe = slice(start * width, end * width)
+            future = executor.submit(
+                render_glyphs, atlas, glyph_index[stripe], fills[stripe], width, cell_size, bg_color, origin
+                )
+            crop = slice((top - start) * cell_size[1], (bottom - start) * cell_size[1])
+            futures.append((future, crop))
+        return np.concatenate([future.result()[crop] for future, crop in futures])
+
+def format_cells(
+    characters: np.ndarray,
+    colors: np.ndarray,
+    output_format: str = "text",
+    color_mode: str = "none",
+    prefix_table: Optional[np.ndarray] = None
+    ) -> List[str]:
+    """Format every character into the string of its output cell
+
+    If a prefix table is given, colors holds indices into this table of ANSI escape prefixes.
+    """
+    if output_format == "text" and color_mode == "ansi":
+        if prefix_table is not None:
+            prefixes = prefix_table[colors]
+        else:
+            # Compose every "\033[38:2;r;g;bm" prefix in bulk
+            channels = DECIMALS[colors]
+            prefixes = np.char.add("\033[38:2;", channels[:, 0])
+            for k in (1, 2):
+                prefixes = np.char.add(np.char.add(prefixes, ";"), channels[:, k])
+            prefixes = np.char.add(prefixes, "m")
+        return np.char.add(np.char.add(prefixes, characters), "\033[0m").tolist()
+
+    if output_format == "html" and color_mode in ["html", "rgb"]:
+        # Compose every "<span style='color:rgb(r,g,b)'>char</span>" in bulk
+        channels = DECIMALS[colors]
+        cells = np.char.add("<span style='color:rgb(", channels[:, 0])
+        for k in (1, 2):
+            cells = np.char.add(np.char.add(cells, ","), channels[:, k])
+        return np.char.add(np.char.add(np.char.add(cells, ")'>"), characters), "</span>").tolist()
+
+    return characters.tolist()
+
+def iter_output_lines(
+    characters: np.ndarray,
+    colors: np.ndarray,
     width: int,
     output_format: str = "text",
     color_mode: str = "none",
     font_name: str = "Courier",
     font_size: int = 12,
-    bg_color: Tuple[int, int, int] = (0, 0, 0)
-    ) -> str:
-    """Format the output into different formats"""
-    pixel_count = len(characters)
-    lines = []
-
-    if output_format == "text":
-        if color_mode == "ansi":
-            for i in range(0, pixel_count, width):
-                line_chars = characters[i:i + width]
-                line_colors = colors[i:i + width]
-                line = []
-                for char, color in zip(line_chars, line_colors):
-                    r, g, b = color
-                    line.append(f"\033[38:2;{r};{g};{b}m{char}\033[0m")
-                lines.append("".join(line))
-        else:
-            for i in range(0, pixel_count, width):
-                lines.append("".join(characters[i:i + width]))
+    bg_color: Tuple[int, int, int] = (0, 0, 0),
+    palette: Optional[np.ndarray] = None
+    ) -> Iterator[str]:
+    """Yield the text or html output line by line, formatting only a few rows at a time
 
-    elif output_format == "html":
-        html = [
+    If a palette is given, colors holds the palette index of every pixel instead of its (r, g, b).
+    """
+    if output_format not in ["text", "html"]:
+        raise ValueError("Only text and html outputs can be produced line by line")
+
+    pixel_count = len(characters)
+    prefix_table = None
+    if palette is not None and output_format == "text" and color_mode == "ansi":
+        # Format the escape prefix once per palette entry and look it up for every pixel
+        prefix_table = np.array([f"\033[38:2;{r};{g};{b}m" for r, g, b in palette.tolist()])
+    elif palette is not None:
+        colors = palette[colors]
+
+    if output_format == "html":
+        yield from [
             "<!DOCTYPE html>",
             "<html>",
             "<head>",
@@ -104,31 +254,45 @@ def format_output(
             "<div class='ascii'>"
             ]
 
-        for i in range(0, pixel_count, width):
-            line_chars = characters[i:i + width]
-            line_colors = colors[i:i + width]
+    # Format a block of whole rows in bulk, then only loop over its rows
+    chunk = ROWS_PER_CHUNK * width
+    for start in range(0, pixel_count, chunk):
+        cells = format_cells(characters[start:start + chunk], colors[start:start + chunk], output_format, color_mode, prefix_table)
+        for i in range(0, len(cells), width):
+            yield "".join(cells[i:i + width])
 
-            if color_mode in ["html", "rgb"]:
-                line = []
-                for char, color in zip(line_chars, line_colors):
-                    r, g, b = color
-                    line.append(f"<span style>='color:rgb({r},{g},{b})'>{char}</span>")
+    if output_format == "html":
+        yield from ["</div>","</body>","</html>"]
 
-                html.append("".join(line))
-            else:
-                html.append("".join(line_chars))
+def format_output(
+    characters: np.ndarray,
+    colors: np.ndarray,
+    width: int,
+    output_format: str = "text",
+    color_mode: str = "none",
+    font_name: str = "Courier",
+    font_size: int = 12,
+    bg_color: Tuple[int, int, int] = (0, 0, 0),
+    palette: Optional[np.ndarray] = None
+    ) -> Union[str, Image.Image]:
+    """Format the output into different formats
+
+    If a palette is given, colors holds the palette index of every pixel instead of its (r, g, b).
+    """
+    pixel_count = len(characters)
 
-        html.extend(["</div>","</body>","</html>"])
-        return "\n".join(html)
+    if output_format in ["text", "html"]:
+        return "\n".join(iter_output_lines(
+            characters, colors, width, output_format, color_mode, font_name, font_size, bg_color, palette
+            ))
 
-    elif output_format == "image":
+    if palette is not None:
+        colors = palette[colors]
+
+    if output_format == "image":
         # Create a new image to render ASCII art
         char_width = font_size // 2 # Approximate character width
-        img_width = width * char_width
-        img_height = (pixel_count // width) * font_size
-
-        img = Image.new("RGB", (img_width, img_height), color=bg_color)
-        draw = ImageDraw.Draw(img)
+        rows = pixel_count // width
 
         try:
             font = ImageFont.truetype(font_name + ".ttf", font_size)
@@ -138,23 +302,34 @@ def format_output(
             except:
                 font = ImageFont.load_default()
 
-        x, y = 0, 0
-        for i, (char, color) in enumerate(zip(characters, colors)):
-            if color_mode != "none":
-                draw.text((x, y), char, fill=color, font=font)
-            else:
-                # Use average brightness as grayscale color
-                avg = sum(color) // 3
-                draw.text((x, y), char, fill=(avg, avg, avg), font=font)
+        # Rasterize each distinct character only once
+        glyphs, glyph_index = np.unique(characters[:rows * width], return_inverse=True)
+        atlas, origin = build_glyph_atlas(glyphs, font, (char_width, font_size))
+
+        if color_mode != "none":
+            fills = colors[:rows * width]
+        else:
+            # Use average brightness as grayscale color
+            gray = (colors[:rows * width].sum(axis=1, dtype=np.uint16) // 3).astype(np.uint8)
+            fills = np.repeat(gray[:, np.newaxis], 3, axis=1)
 
-            x += char_width
-            if (i + 1) % width == 0:
-                x = 0
-                y += font_size
+        if rows * width >= PARALLEL_MIN_CELLS and (os.cpu_count() or 1) > 1:
+            canvas = render_glyphs_parallel(atlas, glyph_index, fills, width, (char_width, font_size), bg_color, origin)
+        else:
+            canvas = render_glyphs(atlas, glyph_index, fills, width, (char_width, font_size), bg_color, origin)
+        return Image.fromarray(canvas)
 
-        return img
+    raise ValueError(f"Invalid output format. Choose from {OUTPUT_FORMATS}")
 
-    return "\n".join(lines)
+def palette_size(value: str) -> int:
+    """Parse the --quantize argument, a palette size between 2 and 256"""
+    try:
+        size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid palette size: '{value}'")
+    if not 2 <= size <= 256:
+        raise argparse.ArgumentTypeError(f"palette size must be between 2 and 256, got {size}")
+    return size
 
 def main():
     # Create a parameter parser
@@ -170,6 +345,7 @@ def main():
     parser.add_argument("--font-size", type=int, default=12, help="Font size for image output")
     parser.add_argument("--bg-color", type=str, default="0,0,0", help="Background color (RGB, comma-separated)")
     parser.add_argument("--char-aspect", type=float, default=0.5, help="Character aspect ratio (default 0.5)")
+    parser.add_argument("--quantize", type=palette_size, default=None, help="Reduce colors to a palette of N colors (2-256)")
 
     args = parser.parse_args()
 
@@ -215,32 +391,50 @@ def main():
             invert=args.invert
             )
 
-        # output formattedly
-        result = format_output(
-            characters, 
-            colors, 
-            args.width, 
-            output_format=output_format,
-            color_mode=args.color,
-            font_name=args.font,
-            font_size=args.font_size,
-            bg_color=bg_color
-            )
+        # reduce colors to a small palette
+        palette = None
+        if args.quantize:
+            colors, palette = quantize_colors(colors, args.quantize)
 
-        # save the result
+        # output formattedly and save the result
         if output_format == "image":
+            result = format_output(
+                characters, 
+                colors, 
+                args.width, 
+                output_format=output_format,
+                color_mode=args.color,
+                font_name=args.font,
+                font_size=args.font_size,
+                bg_color=bg_color,
+                palette=palette
+                )
             result.save(args.output)
             print(f"The picture has been saved to {args.output}")
         else:
+            # Write the lines as they are formatted instead of building the whole output first
+            lines = iter_output_lines(
+                characters, 
+                colors, 
+                args.width, 
+                output_format=output_format,
+                color_mode=args.color,
+                font_name=args.font,
+                font_size=args.font_size,
+                bg_color=bg_color,
+                palette=palette
+                )
             with open(args.output, "w", encoding="utf-8") as f:
-                if isinstance(result, str):
-                    f.write(result)
-                else:
-                    f.write(str(result))
+                f.write(next(lines, ""))
+                for line in lines:
+                    f.write("\n")
+                    f.write(line)
             print(f"The file has been saved to {args.output}")
 
         # If it is in text format and is run in the terminal, display it on the screen
         if output_format == "text" and args.color == "none":
+            with open(args.output, "r", encoding="utf-8") as f:
+                result = f.read(2001)
             print("\nPreview: ")
             print(result[:2000] + "..." if len(result) > 2000 else result)
 